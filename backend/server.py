@@ -1,16 +1,25 @@
-from fastapi import FastAPI, APIRouter, HTTPException, Depends
+from fastapi import FastAPI, APIRouter, HTTPException, Depends, BackgroundTasks
+from fastapi.responses import ORJSONResponse
 from dotenv import load_dotenv
 from starlette.middleware.cors import CORSMiddleware
 import os
 import logging
 from pathlib import Path
-from pydantic import BaseModel, Field
+import asyncio
+import itertools
+import time
+from pydantic import BaseModel, Field, TypeAdapter
 from typing import List, Optional, Dict, Any
 import uuid
 from datetime import datetime, timezone
+from decimal import Decimal
 from supabase import create_client, Client
+from cachetools import TTLCache
+import asyncpg
 import google.generativeai as genai
 import json
+import re
+import orjson
 
 ROOT_DIR = Path(__file__).parent
 load_dotenv(ROOT_DIR / '.env')
@@ -20,46 +29,166 @@ supabase_url = os.environ.get('SUPABASE_URL')
 supabase_key = os.environ.get('SUPABASE_ANON_KEY')
 supabase: Client = create_client(supabase_url, supabase_key)
 
+# Direct Postgres connection used for reads (Supabase pooler DSN)
+supabase_db_url = os.environ.get('SUPABASE_DB_URL')
+
 # Gemini AI configuration with round-robin keys
 GEMINI_API_KEYS = os.environ.get('GEMINI_API_KEYS', '').split(',')
 GEMINI_API_KEYS = [key.strip() for key in GEMINI_API_KEYS if key.strip()]
 
-# Track current key index and failed keys
-current_key_index = 0
-failed_keys = set()
+# Rotate through keys; rate-limited keys sit out until their cooldown expires
+GEMINI_KEY_COOLDOWN_SECONDS = 60
+_key_cycle = itertools.cycle(GEMINI_API_KEYS)
+_key_status: Dict[str, float] = {}  # key -> monotonic time its cooldown ends
 
 def get_next_working_gemini_key():
-    """Get the next working Gemini API key using round-robin"""
-    global current_key_index
-    
+    """Get the next Gemini API key not in cooldown using round-robin"""
     if not GEMINI_API_KEYS:
         raise HTTPException(status_code=500, detail="No Gemini API keys configured")
     
-    # Remove failed keys from available keys
-    available_keys = [key for key in GEMINI_API_KEYS if key not in failed_keys]
-    
-    if not available_keys:
-        # Reset failed keys if all keys have failed (maybe quotas reset)
-        failed_keys.clear()
-        available_keys = GEMINI_API_KEYS
+    now = time.monotonic()
+    for _ in range(len(GEMINI_API_KEYS)):
+        key = next(_key_cycle)
+        if now >= _key_status.get(key, 0):
+            return key
     
-    # Use round-robin to select next key
-    key = available_keys[current_key_index % len(available_keys)]
-    current_key_index = (current_key_index + 1) % len(available_keys)
-    
-    return key
+    # Every key is cooling down; keep rotating rather than failing outright
+    return next(_key_cycle)
+
+def mark_gemini_key_rate_limited(api_key: str):
+    """Take a key out of rotation for the cooldown period"""
+    _key_status[api_key] = time.monotonic() + GEMINI_KEY_COOLDOWN_SECONDS
+
+# Control characters stripped from malformed AI responses before re-parsing
+_CTRL_RE = re.compile(r'[\x00-\x08\x0b\x0c\x0e-\x1f\x7f-\x9f]')
+
+# Structured JSON output configs, shared by every Gemini request
+_QUESTION_GENERATION_CONFIG = genai.types.GenerationConfig(
+    response_mime_type="application/json",
+    temperature=0.7
+)
+_SOLUTION_GENERATION_CONFIG = genai.types.GenerationConfig(
+    response_mime_type="application/json",
+    temperature=0.3  # Lower temperature for more accurate answers
+)
+
+# One Gemini model per API key, reused across requests
+_MODEL_CACHE: Dict[str, genai.GenerativeModel] = {}
 
 def create_gemini_model_with_key(api_key: str):
-    """Create a Gemini model with the specified API key"""
-    genai.configure(api_key=api_key)
-    return genai.GenerativeModel('gemini-2.0-flash')
+    """Get the cached Gemini model for the specified API key, creating it on first use"""
+    model = _MODEL_CACHE.get(api_key)
+    if model is None:
+        # The model binds the globally configured key to its own client on its
+        # first generate call, which always directly follows this configure()
+        genai.configure(api_key=api_key)
+        model = genai.GenerativeModel('gemini-2.0-flash')
+        _MODEL_CACHE[api_key] = model
+    return model
 
 # Create the main app
-app = FastAPI(title="Question Maker API")
+app = FastAPI(title="Question Maker API", default_response_class=ORJSONResponse)
 
 # Create a router with the /api prefix
 api_router = APIRouter(prefix="/api")
 
+async def _init_pg_connection(conn: asyncpg.Connection):
+    """Decode json/jsonb columns into Python objects like the REST client did"""
+    for json_type in ("json", "jsonb"):
+        await conn.set_type_codec(json_type, encoder=json.dumps, decoder=json.loads, schema="pg_catalog")
+
+@app.on_event("startup")
+async def create_pg_pool():
+    """Create the process-wide Postgres connection pool"""
+    if not supabase_db_url:
+        # Without a DSN asyncpg silently falls back to libpq defaults (localhost:5432)
+        raise RuntimeError("No Supabase database URL configured; set SUPABASE_DB_URL")
+    
+    # Supabase fronts Postgres with a transaction-mode pooler, so server-side
+    # prepared statements must not be cached and need unique names
+    app.state.pg_pool = await asyncpg.create_pool(
+        dsn=supabase_db_url,
+        min_size=10,
+        max_size=50,
+        max_inactive_connection_lifetime=300,
+        command_timeout=60,
+        statement_cache_size=0,
+        init=_init_pg_connection,
+        prepared_statement_name_func=lambda: f"__asyncpg_{uuid.uuid4()}__",
+    )
+
+@app.on_event("shutdown")
+async def close_pg_pool():
+    """Close the Postgres connection pool"""
+    await app.state.pg_pool.close()
+
+def _record_to_dict(record: asyncpg.Record) -> Dict[str, Any]:
+    """Convert an asyncpg record into a JSON-friendly dict"""
+    row = {}
+    for key, value in record.items():
+        if isinstance(value, uuid.UUID):
+            value = str(value)
+        elif isinstance(value, Decimal):
+            value = float(value)
+        row[key] = value
+    return row
+
+async def fetch_all(query: str, *args) -> List[Dict[str, Any]]:
+    """Run a parameterized query on the pool and return all rows as dicts"""
+    records = await app.state.pg_pool.fetch(query, *args)
+    return [_record_to_dict(record) for record in records]
+
+async def fetch_one(query: str, *args) -> Optional[Dict[str, Any]]:
+    """Run a parameterized query on the pool and return the first row, if any"""
+    record = await app.state.pg_pool.fetchrow(query, *args)
+    return _record_to_dict(record) if record is not None else None
+
+# Taxonomy rows (exams → topics, parts, slots) change on the order of days
+_TAXONOMY_CACHE: TTLCache = TTLCache(maxsize=256, ttl=300)
+
+async def fetch_all_cached(query: str, *args) -> List[Dict[str, Any]]:
+    """Like fetch_all, but served from the taxonomy TTL cache; callers must not mutate the rows"""
+    key = (query, *args)
+    rows = _TAXONOMY_CACHE.get(key)
+    if rows is None:
+        rows = await fetch_all(query, *args)
+        _TAXONOMY_CACHE[key] = rows
+    return rows
+
+# A topic together with the names of its chapter, unit, subject, course and exam
+_TOPIC_CONTEXT_SQL = """
+SELECT t.id, t.chapter_id, t.name, t.description, t.notes,
+       c.name AS chapter_name,
+       u.name AS unit_name,
+       s.name AS subject_name,
+       co.name AS course_name,
+       e.name AS exam_name
+FROM topics t
+LEFT JOIN chapters c ON c.id = t.chapter_id
+LEFT JOIN units u ON u.id = c.unit_id
+LEFT JOIN subjects s ON s.id = u.subject_id
+LEFT JOIN courses co ON co.id = s.course_id
+LEFT JOIN exams e ON e.id = co.exam_id
+WHERE t.id = $1
+"""
+
+# Topic context rows by id, and ids known not to exist so repeated misses skip the database
+_TOPIC_CONTEXT_CACHE: TTLCache = TTLCache(maxsize=1024, ttl=300)
+_MISSING_TOPIC_CACHE: TTLCache = TTLCache(maxsize=10_000, ttl=60)
+
+async def fetch_topic_context(topic_id: str) -> Optional[Dict[str, Any]]:
+    """Get a topic with its hierarchy names through the topic caches, or None if it does not exist"""
+    if topic_id in _MISSING_TOPIC_CACHE:
+        return None
+    topic = _TOPIC_CONTEXT_CACHE.get(topic_id)
+    if topic is None:
+        topic = await fetch_one(_TOPIC_CONTEXT_SQL, topic_id)
+        if topic is None:
+            _MISSING_TOPIC_CACHE[topic_id] = True
+        else:
+            _TOPIC_CONTEXT_CACHE[topic_id] = topic
+    return topic
+
 # Pydantic models
 class ExamResponse(BaseModel):
     id: str
@@ -192,81 +321,85 @@ class PYQSolutionResponse(BaseModel):
     solution: str
     confidence_level: str
 
+# Validators for models built on hot paths, using the compiled core schema directly
+_GENERATED_QUESTION_ADAPTER = TypeAdapter(GeneratedQuestion)
+_TOPIC_WITH_WEIGHTAGE_ADAPTER = TypeAdapter(TopicWithWeightage)
+
 # API Routes
 
 @api_router.get("/")
 async def root():
     return {"message": "Question Maker API is running"}
 
-@api_router.get("/exams", response_model=List[ExamResponse])
-async def get_exams():
+@api_router.get("/exams", response_model=None, responses={200: {"model": List[ExamResponse]}})
+async def get_exams() -> List[Dict[str, Any]]:
     """Get all available exams"""
     try:
-        result = supabase.table("exams").select("*").execute()
-        return result.data
+        result = await fetch_all_cached("SELECT id, name, description FROM exams")
+        return result
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Error fetching exams: {str(e)}")
 
-@api_router.get("/courses/{exam_id}", response_model=List[CourseResponse])
-async def get_courses(exam_id: str):
+@api_router.get("/courses/{exam_id}", response_model=None, responses={200: {"model": List[CourseResponse]}})
+async def get_courses(exam_id: str) -> List[Dict[str, Any]]:
     """Get courses for a specific exam"""
     try:
-        result = supabase.table("courses").select("*").eq("exam_id", exam_id).execute()
-        return result.data
+        result = await fetch_all_cached("SELECT id, exam_id, name, description FROM courses WHERE exam_id = $1", exam_id)
+        return result
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Error fetching courses: {str(e)}")
 
-@api_router.get("/subjects/{course_id}", response_model=List[SubjectResponse])
-async def get_subjects(course_id: str):
+@api_router.get("/subjects/{course_id}", response_model=None, responses={200: {"model": List[SubjectResponse]}})
+async def get_subjects(course_id: str) -> List[Dict[str, Any]]:
     """Get subjects for a specific course"""
     try:
-        result = supabase.table("subjects").select("*").eq("course_id", course_id).execute()
-        return result.data
+        result = await fetch_all_cached("SELECT id, course_id, name, description FROM subjects WHERE course_id = $1", course_id)
+        return result
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Error fetching subjects: {str(e)}")
 
-@api_router.get("/units/{subject_id}", response_model=List[UnitResponse])
-async def get_units(subject_id: str):
+@api_router.get("/units/{subject_id}", response_model=None, responses={200: {"model": List[UnitResponse]}})
+async def get_units(subject_id: str) -> List[Dict[str, Any]]:
     """Get units for a specific subject"""
     try:
-        result = supabase.table("units").select("*").eq("subject_id", subject_id).execute()
-        return result.data
+        result = await fetch_all_cached("SELECT id, subject_id, name, description FROM units WHERE subject_id = $1", subject_id)
+        return result
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Error fetching units: {str(e)}")
 
-@api_router.get("/chapters/{unit_id}", response_model=List[ChapterResponse])
-async def get_chapters(unit_id: str):
+@api_router.get("/chapters/{unit_id}", response_model=None, responses={200: {"model": List[ChapterResponse]}})
+async def get_chapters(unit_id: str) -> List[Dict[str, Any]]:
     """Get chapters for a specific unit"""
     try:
-        result = supabase.table("chapters").select("*").eq("unit_id", unit_id).execute()
-        return result.data
+        result = await fetch_all_cached("SELECT id, unit_id, name, description FROM chapters WHERE unit_id = $1", unit_id)
+        return result
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Error fetching chapters: {str(e)}")
 
-@api_router.get("/topics/{chapter_id}", response_model=List[TopicResponse])
-async def get_topics(chapter_id: str):
+@api_router.get("/topics/{chapter_id}", response_model=None, responses={200: {"model": List[TopicResponse]}})
+async def get_topics(chapter_id: str) -> List[Dict[str, Any]]:
     """Get topics for a specific chapter"""
     try:
-        result = supabase.table("topics").select("*").eq("chapter_id", chapter_id).execute()
-        return result.data
+        result = await fetch_all_cached("SELECT id, chapter_id, name, description, weightage, notes FROM topics WHERE chapter_id = $1", chapter_id)
+        return result
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Error fetching topics: {str(e)}")
 
-@api_router.get("/parts/{course_id}", response_model=List[PartResponse])
-async def get_parts(course_id: str):
+@api_router.get("/parts/{course_id}", response_model=None, responses={200: {"model": List[PartResponse]}})
+async def get_parts(course_id: str) -> List[Dict[str, Any]]:
     """Get parts for a specific course"""
     try:
-        result = supabase.table("parts").select("*").eq("course_id", course_id).execute()
-        return result.data
+        result = await fetch_all_cached("SELECT id, part_name, course_id FROM parts WHERE course_id = $1", course_id)
+        return result
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Error fetching parts: {str(e)}")
 
-@api_router.get("/slots/{course_id}", response_model=List[SlotResponse])
-async def get_slots(course_id: str):
+@api_router.get("/slots/{course_id}", response_model=None, responses={200: {"model": List[SlotResponse]}})
+async def get_slots(course_id: str) -> List[Dict[str, Any]]:
     """Get slots for a specific course"""
     try:
-        result = supabase.table("slots").select("*").eq("course_id", course_id).execute()
-        return result.data
+        result = await fetch_all_cached("SELECT id, slot_name, course_id FROM slots WHERE course_id = $1", course_id)
+        return result
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Error fetching slots: {str(e)}")
 
@@ -274,8 +407,11 @@ async def get_slots(course_id: str):
 async def get_existing_questions(topic_id: str):
     """Get existing questions for a topic for reference"""
     try:
-        result = supabase.table("questions_topic_wise").select("question_statement, options, answer, solution, question_type").eq("topic_id", topic_id).limit(5).execute()
-        return result.data
+        result = await fetch_all(
+            "SELECT question_statement, options, answer, solution, question_type FROM questions_topic_wise WHERE topic_id = $1 LIMIT 5",
+            topic_id,
+        )
+        return result
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Error fetching existing questions: {str(e)}")
 
@@ -283,11 +419,14 @@ async def get_existing_questions(topic_id: str):
 async def get_pyq_questions_without_solution(topic_id: str):
     """Get PYQ questions for a topic that don't have solutions yet"""
     try:
-        result = supabase.table("questions_topic_wise").select("id, question_statement, options, answer, solution, question_type").eq("topic_id", topic_id).execute()
+        result = await fetch_all(
+            "SELECT id, question_statement, options, answer, solution, question_type FROM questions_topic_wise WHERE topic_id = $1",
+            topic_id,
+        )
 
         # Filter questions without solution
         questions_without_solution = [
-            q for q in result.data
+            q for q in result
             if not q.get('solution') or q.get('solution', '').strip() == ''
         ]
 
@@ -299,29 +438,42 @@ async def get_pyq_questions_without_solution(topic_id: str):
 async def get_generated_questions(topic_id: str):
     """Get previously generated questions for a topic"""
     try:
-        result = supabase.table("new_questions").select("*").eq("topic_id", topic_id).order("created_at", desc=True).limit(10).execute()
-        return result.data
+        result = await fetch_all(
+            "SELECT * FROM new_questions WHERE topic_id = $1 ORDER BY created_at DESC LIMIT 10",
+            topic_id,
+        )
+        return result
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Error fetching generated questions: {str(e)}")
 
+def _parse_indices(answer: str, options: List[str]) -> Optional[List[int]]:
+    """Parse a comma-separated answer into option indices, or None if any index is out of range"""
+    try:
+        n_options = len(options)
+        indices = [int(x) for x in answer.split(",") if x.strip().isdigit()]
+    except (ValueError, TypeError, AttributeError):
+        return None
+    if not all(0 <= idx < n_options for idx in indices):
+        return None
+    return indices
+
 def validate_question_answer(question_type: str, options: List[str], answer: str) -> bool:
     """Validate that the question answer follows the rules"""
-    if question_type == "MCQ":
-        # MCQ should have exactly one correct answer
-        try:
-            answer_indices = [int(x.strip()) for x in answer.split(",") if x.strip().isdigit()]
-            return len(answer_indices) == 1 and all(0 <= idx < len(options) for idx in answer_indices)
-        except (ValueError, TypeError, AttributeError):
+    if question_type in ("MCQ", "MSQ"):
+        answer_indices = _parse_indices(answer, options)
+        if answer_indices is None:
             return False
-    elif question_type == "MSQ":
+        if question_type == "MCQ":
+            # MCQ should have exactly one correct answer
+            return len(answer_indices) == 1
         # MSQ should have one or more correct answers
-        try:
-            answer_indices = [int(x.strip()) for x in answer.split(",") if x.strip().isdigit()]
-            return len(answer_indices) >= 1 and all(0 <= idx < len(options) for idx in answer_indices)
-        except (ValueError, TypeError, AttributeError):
-            return False
+        return len(answer_indices) >= 1
     elif question_type == "NAT":
-        # NAT should be a numerical value
+        # NAT should be a numerical value; plain decimals skip float()
+        if isinstance(answer, str) and answer.isascii():
+            unsigned = answer[1:] if answer.startswith('-') else answer
+            if unsigned.replace('.', '', 1).isdigit():
+                return True
         try:
             float(answer)
             return True
@@ -337,34 +489,34 @@ async def get_all_topics_with_weightage(course_id: str):
     """Get all topics with weightage information for a course"""
     try:
         # Get all subjects for the course
-        subjects_result = supabase.table("subjects").select("*").eq("course_id", course_id).execute()
+        subjects = await get_subjects(course_id)
         all_topics = []
         
-        for subject in subjects_result.data:
+        for subject in subjects:
             # Get units for subject
-            units_result = supabase.table("units").select("*").eq("subject_id", subject["id"]).execute()
+            units = await get_units(subject["id"])
             
-            for unit in units_result.data:
+            for unit in units:
                 # Get chapters for unit
-                chapters_result = supabase.table("chapters").select("*").eq("unit_id", unit["id"]).execute()
+                chapters = await get_chapters(unit["id"])
                 
-                for chapter in chapters_result.data:
+                for chapter in chapters:
                     # Get topics for chapter
-                    topics_result = supabase.table("topics").select("*").eq("chapter_id", chapter["id"]).execute()
+                    topics = await get_topics(chapter["id"])
                     
-                    for topic in topics_result.data:
-                        all_topics.append(TopicWithWeightage(
-                            id=topic["id"],
-                            name=topic["name"],
-                            weightage=topic.get("weightage", 0.0),
-                            notes=topic.get("notes", ""),
-                            chapter_id=chapter["id"],
-                            chapter_name=chapter["name"],
-                            unit_id=unit["id"],
-                            unit_name=unit["name"],
-                            subject_id=subject["id"],
-                            subject_name=subject["name"]
-                        ))
+                    for topic in topics:
+                        all_topics.append(_TOPIC_WITH_WEIGHTAGE_ADAPTER.validate_python({
+                            "id": topic["id"],
+                            "name": topic["name"],
+                            "weightage": topic.get("weightage", 0.0),
+                            "notes": topic.get("notes", ""),
+                            "chapter_id": chapter["id"],
+                            "chapter_name": chapter["name"],
+                            "unit_id": unit["id"],
+                            "unit_name": unit["name"],
+                            "subject_id": subject["id"],
+                            "subject_name": subject["name"]
+                        }))
         
         return all_topics
     except Exception as e:
@@ -398,6 +550,7 @@ async def create_auto_generation_session(config: AutoGenerationConfig, exam_id:
                     topic.estimated_questions = max(1, int(exact_questions + 0.5))
         
         session_id = str(uuid.uuid4())
+        now = datetime.now(timezone.utc)
         session = AutoGenerationSession(
             id=session_id,
             exam_id=exam_id,
@@ -405,8 +558,8 @@ async def create_auto_generation_session(config: AutoGenerationConfig, exam_id:
             config=config,
             questions_target=config.total_questions,
             generation_mode=generation_mode,
-            created_at=datetime.now(timezone.utc),
-            updated_at=datetime.now(timezone.utc)
+            created_at=now,
+            updated_at=now
         )
         
         # For now, we'll return the session. In a real implementation, you'd store this in a sessions table
@@ -419,16 +572,10 @@ async def create_auto_generation_session(config: AutoGenerationConfig, exam_id:
 async def generate_pyq_solution(request: PYQSolutionRequest):
     """Generate answer and solution for a PYQ question"""
     try:
-        # Get topic information for context
-        topic_result = supabase.table("topics").select("*").eq("id", request.topic_id).execute()
-        if not topic_result.data:
+        # Get topic information joined with its chapter and course for context
+        topic = await fetch_topic_context(request.topic_id)
+        if not topic:
             raise HTTPException(status_code=404, detail="Topic not found")
-        
-        topic = topic_result.data[0]
-        
-        # Get chapter and course information for better context
-        chapter_result = supabase.table("chapters").select("*").eq("id", topic["chapter_id"]).execute()
-        chapter = chapter_result.data[0] if chapter_result.data else {}
 
         # Get notes for the topic
         topic_notes = topic.get('notes', '')
@@ -438,7 +585,7 @@ async def generate_pyq_solution(request: PYQSolutionRequest):
 You are an expert educator and question solver. Analyze the following previous year question and provide the correct answer and detailed solution.
 
 Topic: {topic['name']}
-Chapter: {chapter.get('name', '')}
+Chapter: {topic['chapter_name'] or ''}
 Question Type: {request.question_type}
 
 IMPORTANT CONTEXT - Study Notes from this Chapter:
@@ -483,14 +630,8 @@ Respond in the following JSON format:
                 # Create model with current key
                 model = create_gemini_model_with_key(current_api_key)
                 
-                # Configure generation for structured JSON output
-                generation_config = genai.types.GenerationConfig(
-                    response_mime_type="application/json",
-                    temperature=0.3  # Lower temperature for more accurate answers
-                )
-                
                 # Generate content with structured output
-                response = model.generate_content(prompt, generation_config=generation_config)
+                response = await model.generate_content_async(prompt, generation_config=_SOLUTION_GENERATION_CONFIG)
                 break
                 
             except Exception as e:
@@ -499,7 +640,7 @@ Respond in the following JSON format:
                 
                 # Check if it's a quota/authentication error
                 if "quota" in error_str or "429" in error_str or "exceeded" in error_str or "invalid api key" in error_str:
-                    failed_keys.add(current_api_key)
+                    mark_gemini_key_rate_limited(current_api_key)
                     if attempt == max_retries - 1:
                         raise HTTPException(status_code=429, detail=f"All Gemini API keys exhausted. Last error: {str(e)}")
                     continue
@@ -512,8 +653,8 @@ Respond in the following JSON format:
         # Parse the JSON response
         try:
             response_text = response.text.strip()
-            solution_data = json.loads(response_text)
-        except json.JSONDecodeError as e:
+            solution_data = orjson.loads(response_text)
+        except orjson.JSONDecodeError as e:
             raise HTTPException(status_code=500, detail=f"Error parsing AI response: {str(e)}")
 
         # Validate the solution
@@ -536,7 +677,9 @@ Respond in the following JSON format:
                 "updated_at": datetime.now(timezone.utc).isoformat()
             }
 
-            supabase.table("questions_topic_wise").update(update_data).eq("id", request.question_id).execute()
+            await asyncio.to_thread(
+                lambda: supabase.table("questions_topic_wise").update(update_data).eq("id", request.question_id).execute()
+            )
         except Exception as update_error:
             # Log the error but don't fail the entire request
             print(f"Warning: Failed to update question with solution: {str(update_error)}")
@@ -548,58 +691,71 @@ Respond in the following JSON format:
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Error generating PYQ solution: {str(e)}")
 
-@api_router.post("/generate-question", response_model=GeneratedQuestion)
-async def generate_question(request: QuestionRequest):
-    """Generate a new question using Gemini AI"""
-    try:
-        # Get topic information
-        topic_result = supabase.table("topics").select("*").eq("id", request.topic_id).execute()
-        if not topic_result.data:
-            raise HTTPException(status_code=404, detail="Topic not found")
-        
-        topic = topic_result.data[0]
-        
-        # Get chapter information for context
-        chapter_result = supabase.table("chapters").select("*").eq("id", topic["chapter_id"]).execute()
-        chapter = chapter_result.data[0] if chapter_result.data else {}
-        
-        # Get unit information
-        unit_result = supabase.table("units").select("*").eq("id", chapter.get("unit_id", "")).execute()
-        unit = unit_result.data[0] if unit_result.data else {}
-        
-        # Get subject information
-        subject_result = supabase.table("subjects").select("*").eq("id", unit.get("subject_id", "")).execute()
-        subject = subject_result.data[0] if subject_result.data else {}
-        
-        # Get course information
-        course_result = supabase.table("courses").select("*").eq("id", subject.get("course_id", "")).execute()
-        course = course_result.data[0] if course_result.data else {}
-        
-        # Get exam information
-        exam_result = supabase.table("exams").select("*").eq("id", course.get("exam_id", "")).execute()
-        exam = exam_result.data[0] if exam_result.data else {}
-        
-        # Get existing questions for reference (but not to copy)
-        existing_questions = supabase.table("questions_topic_wise").select("question_statement, options, question_type").eq("topic_id", request.topic_id).limit(5).execute()
-        
-        # Get previously generated questions to avoid repetition
-        generated_questions = supabase.table("new_questions").select("question_statement").eq("topic_id", request.topic_id).limit(10).execute()
-        
-        # Create prompt for Gemini
-        prompt = f"""
-You are an expert question creator for educational content. Generate a {request.question_type} type question for the following topic:
+# Serialized reference questions per topic, dropped whenever new questions for the topic are saved
+_PROMPT_CONTEXT_CACHE: TTLCache = TTLCache(maxsize=1024, ttl=600)
+# Bumped on every invalidation, so a fetch that overlapped a save is not cached
+_PROMPT_CONTEXT_VERSIONS: Dict[str, int] = {}
+
+def _invalidate_prompt_context(topic_id: str):
+    """Drop a topic's cached prompt context after questions for it were saved"""
+    _PROMPT_CONTEXT_CACHE.pop(topic_id, None)
+    _PROMPT_CONTEXT_VERSIONS[topic_id] = _PROMPT_CONTEXT_VERSIONS.get(topic_id, 0) + 1
+
+def _pending_statements(topic_id: str) -> List[str]:
+    """Statements of generated questions for a topic that are not in the database yet"""
+    return [
+        q["question_statement"]
+        for q in itertools.chain(_INSERT_BUFFER, _IN_FLIGHT_QUESTIONS)
+        if q["topic_id"] == topic_id
+    ]
+
+def _dump_statements(statements: List[str]) -> str:
+    """Serialize question statements as indented JSON for the prompt"""
+    return orjson.dumps(statements, option=orjson.OPT_INDENT_2).decode()
+
+async def _prompt_context(topic_id: str) -> Dict[str, str]:
+    """Get the existing and previously generated question statements for a topic as prompt-ready JSON"""
+    # Taken before any fetch: a question flushed while we wait is either in
+    # this snapshot or in the fetched rows
+    pending = _pending_statements(topic_id)
+    context = _PROMPT_CONTEXT_CACHE.get(topic_id)
+    if context is None:
+        version = _PROMPT_CONTEXT_VERSIONS.get(topic_id, 0)
+        existing_questions, generated_questions = await asyncio.gather(
+            # Existing questions for reference (but not to copy)
+            fetch_all("SELECT question_statement FROM questions_topic_wise WHERE topic_id = $1 LIMIT 3", topic_id),
+            # Previously generated questions to avoid repetition
+            fetch_all("SELECT question_statement FROM new_questions WHERE topic_id = $1 LIMIT 10", topic_id),
+        )
+        generated = [q['question_statement'] for q in generated_questions]
+        context = {
+            "existing_json": _dump_statements([q['question_statement'] for q in existing_questions]),
+            "generated": generated,
+            "generated_json": _dump_statements(generated),
+        }
+        if _PROMPT_CONTEXT_VERSIONS.get(topic_id, 0) == version:
+            _PROMPT_CONTEXT_CACHE[topic_id] = context
+
+    generated_json = context["generated_json"]
+    if pending:
+        generated_json = _dump_statements(list(dict.fromkeys(pending + context["generated"])))
+    return {"existing_json": context["existing_json"], "generated_json": generated_json}
+
+# Prompt for generate_question; filled with str.format_map, so literal braces are doubled
+_QUESTION_PROMPT_TMPL = """
+You are an expert question creator for educational content. Generate a {question_type} type question for the following topic:
 
 EXAM CONTEXT:
-- Exam: {exam.get('name', 'Unknown Exam')}
-- Course: {course.get('name', 'Unknown Course')}
-- Subject: {subject.get('name', 'Unknown Subject')}
-- Unit: {unit.get('name', 'Unknown Unit')}
-- Chapter: {chapter.get('name', 'Unknown Chapter')}
-- Topic: {topic['name']}
+- Exam: {exam_name}
+- Course: {course_name}
+- Subject: {subject_name}
+- Unit: {unit_name}
+- Chapter: {chapter_name}
+- Topic: {topic_name}
 
-IMPORTANT: Create questions appropriate for the {exam.get('name', 'exam')} difficulty level and {course.get('name', 'course')} standards. Keep the difficulty suitable for this specific exam and course context.
+IMPORTANT: Create questions appropriate for the {exam_name} difficulty level and {course_name} standards. Keep the difficulty suitable for this specific exam and course context.
 
-Topic Description: {topic.get('description', '')}
+Topic Description: {topic_description}
 
 Question Type Rules:
 - MCQ: Multiple Choice Question with exactly ONE correct answer (4 options)
@@ -608,15 +764,15 @@ Question Type Rules:
 - SUB: Subjective question with descriptive answer (no options)
 
 Context from existing questions (DO NOT COPY, use for inspiration only):
-{json.dumps([q['question_statement'] for q in existing_questions.data[:3]], indent=2)}
+{existing_json}
 
 Previously generated questions in this topic (AVOID similar content - generate something completely different):
-{json.dumps([q['question_statement'] for q in generated_questions.data], indent=2)}
+{generated_json}
 
 Requirements:
 1. Generate a FRESH, ORIGINAL question that tests understanding of the topic
-2. Make it educationally valuable and appropriately challenging for {exam.get('name', 'the exam')}
-3. Ensure difficulty is suitable for {course.get('name', 'the course')} level
+2. Make it educationally valuable and appropriately challenging for {exam_name}
+3. Ensure difficulty is suitable for {course_name} level
 4. For MCQ/MSQ: Provide exactly 4 options with realistic distractors
 5. Ensure the answer follows the question type rules strictly
 6. Provide a detailed solution explanation with clear steps
@@ -632,6 +788,98 @@ Please respond in the following JSON format:
 }}
 """
 
+# Generated questions waiting to be written in one bulk insert
+QUESTION_FLUSH_SIZE = 20
+QUESTION_FLUSH_INTERVAL_SECONDS = 2
+_INSERT_BUFFER: List[dict] = []
+_insert_buffer_lock = asyncio.Lock()
+# Questions taken off the buffer whose insert has not finished yet
+_IN_FLIGHT_QUESTIONS: List[dict] = []
+
+async def _flush_questions():
+    """Save all buffered questions with a single multi-row insert, logging instead of raising on failure"""
+    async with _insert_buffer_lock:
+        if not _INSERT_BUFFER:
+            return
+        batch = _INSERT_BUFFER.copy()
+        _INSERT_BUFFER.clear()
+        _IN_FLIGHT_QUESTIONS.extend(batch)
+
+    try:
+        result = await asyncio.to_thread(lambda: supabase.table("new_questions").insert(batch).execute())
+        if not result.data:
+            logger.error(f"Error saving {len(batch)} questions to database: empty insert result")
+    except Exception as e:
+        # The multi-row insert is one statement, so a single bad row fails the
+        # whole batch; retry row by row so only that question is lost
+        logger.warning(f"Bulk insert of {len(batch)} questions failed, retrying individually: {str(e)}")
+        for question in batch:
+            await _insert_question(question)
+    finally:
+        for question in batch:
+            _IN_FLIGHT_QUESTIONS.remove(question)
+            _invalidate_prompt_context(question["topic_id"])
+
+async def _insert_question(question: dict):
+    """Save a single question, logging instead of raising on failure"""
+    try:
+        result = await asyncio.to_thread(lambda: supabase.table("new_questions").insert(question).execute())
+        if not result.data:
+            logger.error(f"Error saving question {question['id']} to database: empty insert result")
+    except Exception as e:
+        logger.error(f"Error saving question {question['id']} to database: {str(e)}")
+
+async def _flush_questions_periodically():
+    """Flush the insert buffer on a fixed interval so small batches are not held back"""
+    while True:
+        await asyncio.sleep(QUESTION_FLUSH_INTERVAL_SECONDS)
+        await _flush_questions()
+
+async def _persist_question(new_question: dict):
+    """Queue a generated question for the next bulk insert"""
+    async with _insert_buffer_lock:
+        _INSERT_BUFFER.append(new_question)
+        buffer_full = len(_INSERT_BUFFER) >= QUESTION_FLUSH_SIZE
+
+    if buffer_full:
+        await _flush_questions()
+
+@app.on_event("startup")
+async def start_question_flusher():
+    """Start the periodic flush of buffered question inserts"""
+    app.state.question_flush_task = asyncio.create_task(_flush_questions_periodically())
+
+@app.on_event("shutdown")
+async def stop_question_flusher():
+    """Stop the periodic flush and write out anything still buffered"""
+    app.state.question_flush_task.cancel()
+    await _flush_questions()
+
+@api_router.post("/generate-question", response_model=GeneratedQuestion)
+async def generate_question(request: QuestionRequest, background_tasks: BackgroundTasks):
+    """Generate a new question using Gemini AI"""
+    try:
+        # Topic with its full exam hierarchy; unknown ids stop here, before any
+        # reference questions are fetched or cached for them
+        topic = await fetch_topic_context(request.topic_id)
+        if not topic:
+            raise HTTPException(status_code=404, detail="Topic not found")
+
+        prompt_context = await _prompt_context(request.topic_id)
+        
+        # Create prompt for Gemini
+        prompt = _QUESTION_PROMPT_TMPL.format_map({
+            "question_type": request.question_type,
+            "exam_name": topic['exam_name'] or 'Unknown Exam',
+            "course_name": topic['course_name'] or 'Unknown Course',
+            "subject_name": topic['subject_name'] or 'Unknown Subject',
+            "unit_name": topic['unit_name'] or 'Unknown Unit',
+            "chapter_name": topic['chapter_name'] or 'Unknown Chapter',
+            "topic_name": topic['name'],
+            "topic_description": topic.get('description', ''),
+            **prompt_context,
+        })
+
         # Generate response from Gemini with round-robin key handling
         max_retries = len(GEMINI_API_KEYS)
         last_error = None
@@ -644,14 +892,8 @@ Please respond in the following JSON format:
                 # Create model with current key
                 model = create_gemini_model_with_key(current_api_key)
                 
-                # Configure generation for structured JSON output
-                generation_config = genai.types.GenerationConfig(
-                    response_mime_type="application/json",
-                    temperature=0.7
-                )
-                
                 # Generate content with structured output
-                response = model.generate_content(prompt, generation_config=generation_config)
+                response = await model.generate_content_async(prompt, generation_config=_QUESTION_GENERATION_CONFIG)
                 
                 # If successful, break out of retry loop
                 break
@@ -662,9 +904,9 @@ Please respond in the following JSON format:
                 
                 # Check if it's a quota/authentication error
                 if "quota" in error_str or "429" in error_str or "exceeded" in error_str or "invalid api key" in error_str:
-                    # Mark current key as failed
-                    failed_keys.add(current_api_key)
-                    print(f"API key failed (quota/auth error), marked as failed: {current_api_key[:10]}...")
+                    # Put current key into cooldown
+                    mark_gemini_key_rate_limited(current_api_key)
+                    print(f"API key failed (quota/auth error), cooling down: {current_api_key[:10]}...")
                     
                     # If this was the last attempt, raise the error
                     if attempt == max_retries - 1:
@@ -687,13 +929,11 @@ Please respond in the following JSON format:
             # Since we're using structured output (application/json), 
             # the response should be valid JSON directly
             try:
-                generated_data = json.loads(response_text)
-            except json.JSONDecodeError:
+                generated_data = orjson.loads(response_text)
+            except orjson.JSONDecodeError:
                 # Fallback: try to extract and clean JSON manually
-                import re
-                
                 # Remove control characters
-                cleaned_text = re.sub(r'[\x00-\x08\x0b\x0c\x0e-\x1f\x7f-\x9f]', '', response_text)
+                cleaned_text = _CTRL_RE.sub('', response_text)
                 
                 # Find JSON object bounds
                 start_idx = cleaned_text.find('{')
@@ -708,9 +948,9 @@ Please respond in the following JSON format:
                 json_str = json_str.replace('\n', '\\n').replace('\t', '\\t').replace('\r', '\\r')
                 
                 # Try parsing again
-                generated_data = json.loads(json_str)
+                generated_data = orjson.loads(json_str)
             
-        except (json.JSONDecodeError, ValueError) as e:
+        except (orjson.JSONDecodeError, ValueError) as e:
             raise HTTPException(status_code=500, detail=f"Error parsing AI response: {str(e)}")
 
         # Handle case where Gemini returns an array instead of a single object
@@ -732,6 +972,7 @@ Please respond in the following JSON format:
             raise HTTPException(status_code=400, detail=f"Generated question doesn't meet {request.question_type} validation rules")
 
         # Create new question record
+        now_iso = datetime.now(timezone.utc).isoformat()
         new_question = {
             "id": str(uuid.uuid4()),
             "topic_id": request.topic_id,
@@ -748,17 +989,14 @@ Please respond in the following JSON format:
             "incorrect_marks": request.incorrect_marks,
             "skipped_marks": request.skipped_marks,
             "time_minutes": request.time_minutes,
-            "created_at": datetime.now(timezone.utc).isoformat(),
-            "updated_at": datetime.now(timezone.utc).isoformat()
+            "created_at": now_iso,
+            "updated_at": now_iso
         }
 
-        # Save to database
-        result = supabase.table("new_questions").insert(new_question).execute()
-        
-        if not result.data:
-            raise HTTPException(status_code=500, detail="Error saving question to database")
+        # Save to database after the response has been sent
+        background_tasks.add_task(_persist_question, new_question)
 
-        return GeneratedQuestion(**new_question)
+        return _GENERATED_QUESTION_ADAPTER.validate_python(new_question)
 
     except HTTPException:
         raise
@@ -772,15 +1010,19 @@ async def save_question_manually(question_data: dict):
         # Always generate a new UUID to avoid conflicts
         new_id = str(uuid.uuid4())
         question_data["id"] = new_id
-        question_data["created_at"] = datetime.now(timezone.utc).isoformat()
-        question_data["updated_at"] = datetime.now(timezone.utc).isoformat()
+        now_iso = datetime.now(timezone.utc).isoformat()
+        question_data["created_at"] = now_iso
+        question_data["updated_at"] = now_iso
         
         # Save to database
-        result = supabase.table("new_questions").insert(question_data).execute()
+        result = await asyncio.to_thread(lambda: supabase.table("new_questions").insert(question_data).execute())
         
         if not result.data:
             raise HTTPException(status_code=500, detail="Error saving question to database")
         
+        # The topic's avoid-repetition list now includes this question
+        _invalidate_prompt_context(question_data.get("topic_id"))
+        
         return {"message": "Question saved successfully", "question_id": new_id}
         
     except Exception as e:
@@ -846,17 +1088,23 @@ async def get_auto_generation_progress(session_id: str):
 # Include the router in the main app
 app.include_router(api_router)
 
-app.add_middleware(
-    CORSMiddleware,
-    allow_credentials=True,
-    allow_origins=os.environ.get('CORS_ORIGINS', '*').split(','),
-    allow_methods=["*"],
-    allow_headers=["*"],
-)
-
 # Configure logging
 logging.basicConfig(
     level=logging.INFO,
     format='%(asctime)s - %(name)s - %(levelname)s - %(message)s'
 )
-logger = logging.getLogger(__name__)
\ No newline at end of file
+logger = logging.getLogger(__name__)
+
+_CORS_ORIGINS = [origin.strip() for origin in os.environ.get('CORS_ORIGINS', '*').split(',') if origin.strip()]
+_CORS_ALLOW_CREDENTIALS = "*" not in _CORS_ORIGINS
+if not _CORS_ALLOW_CREDENTIALS:
+    logger.info("CORS_ORIGINS allows any origin; disabling credentialed CORS requests")
+
+app.add_middleware(
+    CORSMiddleware,
+    allow_credentials=_CORS_ALLOW_CREDENTIALS,
+    allow_origins=_CORS_ORIGINS,
+    allow_methods=["*"],
+    allow_headers=["*"],
+    max_age=86400,  # let browsers cache preflight responses for a day
+)
\ No newline at end of file
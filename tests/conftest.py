@@ -0,0 +1,8 @@
+import os
+import sys
+from pathlib import Path
+
+# server.py lives in backend/ and builds its Supabase client at import time
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / "backend"))
+os.environ.setdefault("SUPABASE_URL", "https://example.supabase.co")
+os.environ.setdefault("SUPABASE_ANON_KEY", "test-anon-key")
@@ -0,0 +1,53 @@
+import itertools
+
+import pytest
+from fastapi import HTTPException
+
+import server
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(server.time, "monotonic", lambda: now[0])
+    return now
+
+
+def use_keys(monkeypatch, keys):
+    monkeypatch.setattr(server, "GEMINI_API_KEYS", keys)
+    monkeypatch.setattr(server, "_key_cycle", itertools.cycle(keys))
+    monkeypatch.setattr(server, "_key_status", {})
+
+
+def test_keys_rotate_round_robin(monkeypatch, clock):
+    use_keys(monkeypatch, ["a", "b", "c"])
+    assert [server.get_next_working_gemini_key() for _ in range(4)] == ["a", "b", "c", "a"]
+
+
+def test_rate_limited_key_is_skipped(monkeypatch, clock):
+    use_keys(monkeypatch, ["a", "b", "c"])
+    server.mark_gemini_key_rate_limited("b")
+    assert [server.get_next_working_gemini_key() for _ in range(4)] == ["a", "c", "a", "c"]
+
+
+def test_rate_limited_key_rejoins_after_cooldown(monkeypatch, clock):
+    use_keys(monkeypatch, ["a", "b"])
+    server.mark_gemini_key_rate_limited("b")
+    assert [server.get_next_working_gemini_key() for _ in range(2)] == ["a", "a"]
+
+    clock[0] += server.GEMINI_KEY_COOLDOWN_SECONDS
+    assert [server.get_next_working_gemini_key() for _ in range(2)] == ["b", "a"]
+
+
+def test_all_keys_cooling_down_still_returns_a_key(monkeypatch, clock):
+    use_keys(monkeypatch, ["a", "b"])
+    server.mark_gemini_key_rate_limited("a")
+    server.mark_gemini_key_rate_limited("b")
+    assert server.get_next_working_gemini_key() in ("a", "b")
+
+
+def test_no_keys_configured(monkeypatch):
+    use_keys(monkeypatch, [])
+    with pytest.raises(HTTPException) as exc_info:
+        server.get_next_working_gemini_key()
+    assert exc_info.value.status_code == 500
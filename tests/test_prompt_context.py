@@ -0,0 +1,58 @@
+import asyncio
+
+import orjson
+import pytest
+
+import server
+
+TOPIC_ID = "topic-1"
+
+
+@pytest.fixture(autouse=True)
+def clean_state(monkeypatch):
+    monkeypatch.setattr(server, "_PROMPT_CONTEXT_CACHE", server.TTLCache(maxsize=16, ttl=600))
+    monkeypatch.setattr(server, "_PROMPT_CONTEXT_VERSIONS", {})
+    monkeypatch.setattr(server, "_INSERT_BUFFER", [])
+    monkeypatch.setattr(server, "_IN_FLIGHT_QUESTIONS", [])
+
+
+def stored_questions(statements, on_fetch=None):
+    async def fetch_all(query, *args):
+        if on_fetch is not None:
+            on_fetch()
+        if "new_questions" in query:
+            return [{"question_statement": s} for s in statements]
+        return []
+    return fetch_all
+
+
+def generated(context):
+    return orjson.loads(context["generated_json"])
+
+
+def test_buffered_question_is_in_avoid_list(monkeypatch):
+    monkeypatch.setattr(server, "fetch_all", stored_questions(["stored"]))
+    asyncio.run(server._prompt_context(TOPIC_ID))  # warm the cache
+
+    server._INSERT_BUFFER.append({"topic_id": TOPIC_ID, "question_statement": "just generated"})
+    server._IN_FLIGHT_QUESTIONS.append({"topic_id": TOPIC_ID, "question_statement": "being saved"})
+    server._INSERT_BUFFER.append({"topic_id": "other", "question_statement": "unrelated"})
+
+    context = asyncio.run(server._prompt_context(TOPIC_ID))
+    assert generated(context) == ["just generated", "being saved", "stored"]
+
+
+def test_fetch_overlapping_a_save_is_not_cached(monkeypatch):
+    def save_during_fetch():
+        server._invalidate_prompt_context(TOPIC_ID)
+
+    monkeypatch.setattr(server, "fetch_all", stored_questions(["stored"], on_fetch=save_during_fetch))
+    asyncio.run(server._prompt_context(TOPIC_ID))
+    assert TOPIC_ID not in server._PROMPT_CONTEXT_CACHE
+
+
+def test_fetch_is_cached_without_pending_questions(monkeypatch):
+    monkeypatch.setattr(server, "fetch_all", stored_questions(["stored"]))
+    context = asyncio.run(server._prompt_context(TOPIC_ID))
+    assert generated(context) == ["stored"]
+    assert TOPIC_ID in server._PROMPT_CONTEXT_CACHE
@@ -0,0 +1,57 @@
+import pytest
+
+import server
+
+OPTIONS = ["A", "B", "C", "D"]
+
+
+def test_parse_indices():
+    assert server._parse_indices("0, 2", OPTIONS) == [0, 2]
+    assert server._parse_indices("4", OPTIONS) is None
+    assert server._parse_indices("1", None) is None
+    assert server._parse_indices(2, OPTIONS) is None
+
+
+@pytest.mark.parametrize("answer, expected", [
+    ("2", True),
+    ("0,1", False),
+    ("4", False),
+    ("-1", False),
+    ("", False),
+    (2, False),
+])
+def test_mcq(answer, expected):
+    assert server.validate_question_answer("MCQ", OPTIONS, answer) is expected
+
+
+@pytest.mark.parametrize("answer, expected", [
+    ("0,2", True),
+    ("0, 1, 3", True),
+    ("1,4", False),
+    ("", False),
+])
+def test_msq(answer, expected):
+    assert server.validate_question_answer("MSQ", OPTIONS, answer) is expected
+
+
+@pytest.mark.parametrize("answer, expected", [
+    ("42", True),
+    ("-3.5", True),
+    ("-.5", True),
+    ("1e3", True),
+    (" 7 ", True),
+    ("--5", False),
+    ("²", False),
+    ("1.2.3", False),
+    ("-", False),
+    ("abc", False),
+    (None, False),
+])
+def test_nat(answer, expected):
+    assert server.validate_question_answer("NAT", None, answer) is expected
+
+
+def test_sub_and_unknown_type():
+    assert server.validate_question_answer("SUB", None, "An explanation") is True
+    assert server.validate_question_answer("SUB", None, "   ") is False
+    assert server.validate_question_answer("XYZ", OPTIONS, "0") is False